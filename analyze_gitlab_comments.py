@@ -1,24 +1,82 @@
+import asyncio
+import contextlib
 import csv
-import json
+import functools
+import hashlib
+import io
+import logging
 import uuid
 import subprocess
 import argparse
+import os
 import re
+import shelve
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from operator import itemgetter
+import aiohttp
 import gitlab
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI, BadRequestError
 import config
-from tenacity import retry, stop_after_attempt, wait_random_exponential  # for exponential backoff
+from tenacity import AsyncRetrying, retry_if_not_exception_type, stop_after_attempt, wait_random_exponential  # for exponential backoff
+
+logger = logging.getLogger(__name__)
+
+# GitLab.com allows roughly 10 authenticated API requests per second
+GITLAB_REQUESTS_PER_SECOND = 10
+GITLAB_MAX_RETRIES = 10
+# Number of discussion fetching workers, i.e. of GitLab requests in flight
+DISCUSSIONS_CONCURRENCY = 10
+ANALYZE_CONCURRENCY = 8
+# Wall-clock budget of a single GPT answer, in seconds
+ANALYZE_TIMEOUT = 30
+WRITE_BUFFER_SIZE = 1 << 20
+STDOUT_BUFFER_SIZE = 1 << 16
+# Below this size, spawning worker processes costs more than parsing the previous output sequentially
+PARALLEL_PARSE_MIN_SIZE = 1 << 20
+GPT_MODEL = "gpt-4"
+# Prompt size budget of a batched GPT request, keeping it well under gpt-4's 8k tokens context (~3 chars per token)
+ANALYZE_BATCH_MAX_CHARS = 20000
+CSV_FIELDNAMES = ['MR IID', 'First Note Date', 'Note Count', 'Analyze', 'Reviewers']
+
+# Prefix of a note line in the previous output, e.g. "2023-12-01T10:20:30.123Z - "
+_TS_RE = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z - ')
+_REVIEW_PROMPT = ("Get me the insight from this code review discussion. up to 7 words:"
+                  "\n\"\n{conversation}\n\".\n"
+                  "The discussion refers to the code change introduced by the following diff - "
+                  "the exact change is ranged between lines {s_line} ({s_type}) and {e_line} ({e_type}):"
+                  "\n```\n{diff_text}\n```\n")
+_BATCH_PROMPT = ("Answer each of the following {count} independent requests, separated by \"### Request <i>\" "
+                 "lines. Reply with a JSON object only, {{\"insights\": [...]}}, where element i of the array is "
+                 "the answer to request i.\n")
+_BATCH_PROMPT_ITEM = "\n### Request {index}\n{prompt}"
+# Diff hunk header, e.g. "@@ -12965,7 +12965,8 @@"
+_HUNK_RE = re.compile(r'@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@')
 
 
 def convert_time_format(at):
+    # GitLab timestamps have a fixed layout (YYYY-MM-DDTHH:MM:SS.fffZ), so reorder the fields directly
+    # instead of going through strptime. %f pads the fraction to microseconds, so does this.
+    if len(at) > 20 and at[19] == '.' and at[-1] == 'Z':
+        return f"{at[8:10]}-{at[5:7]}-{at[0:4]} {at[11:19]}.{at[20:-1]:0<6}"
     return datetime.strptime(at, '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%d-%m-%Y %H:%M:%S.%f')
 
 
 def save_dict_to_json(data, file_path):
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    with open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        if not isinstance(data, list):
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            return
+        # Serialize one conversation at a time rather than holding the whole formatted document in memory
+        f.write(b'[')
+        for i, item in enumerate(data):
+            f.write(b',\n' if i else b'\n')
+            f.write(orjson.dumps(item, option=orjson.OPT_INDENT_2))
+        f.write(b'\n]' if data else b']')
 
 
 def load_json_to_dict(file_path):
@@ -32,72 +90,184 @@ def load_json_to_dict(file_path):
     dict: The dictionary loaded from the JSON file.
     """
     try:
-        with open(file_path, 'r') as file:
-            return json.load(file)
+        with open(file_path, 'rb') as file:
+            return orjson.loads(file.read())
     except Exception as e:
         print(f"Error loading JSON file: {e}")
         return {}
 
 
-def extract_gitlab_conversations(args):
-    personal_access_token = args.gitlab_access_token
-    gl = gitlab.Gitlab(config.GITLAB_URL, private_token=personal_access_token)
-    project = gl.projects.get(config.PROJECT_PATH)
-    project_web_url = project.web_url
-    page = 1
-    per_page = 20
+class RateLimiter:
+    """
+    Spaces out the requests sent from an event loop to at most `rate` per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def get_gitlab_json(session, rate_limiter, url, params=None):
+    """
+    GET a GitLab API URL, waiting and retrying on rate limiting (429) and server errors the way python-gitlab
+    does.
+
+    :return: The decoded JSON response, and the URL of the next page if any.
+    """
+    for attempt in range(GITLAB_MAX_RETRIES + 1):
+        await rate_limiter.wait()
+        async with session.get(url, params=params) as response:
+            if (response.status == 429 or response.status >= 500) and attempt < GITLAB_MAX_RETRIES:
+                try:
+                    delay = float(response.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    delay = 2 ** attempt * 0.1
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            next_link = response.links.get('next')
+            # The next link already carries the query string
+            return await response.json(), next_link['url'] if next_link else None
+
+
+async def fetch_discussions(session, rate_limiter, api_url, project_id, mr_iid):
+    """
+    Fetch all the discussions of a merge request from the GitLab REST API.
+
+    :param session: The aiohttp session holding the GitLab authentication headers.
+    :param rate_limiter: The RateLimiter shared by all the GitLab requests.
+    :param api_url: The GitLab API base URL (e.g. https://gitlab.com/api/v4).
+    :param project_id: The id of the project the merge request belongs to.
+    :param mr_iid: The internal id of the merge request.
+    :return: The list of discussions, as returned by the API.
+    """
+    url = f"{api_url}/projects/{project_id}/merge_requests/{mr_iid}/discussions"
+    params = {'per_page': 100}
+    discussions = []
+    while url:
+        page, url = await get_gitlab_json(session, rate_limiter, url, params)
+        discussions.extend(page)
+        params = None
+    return discussions
+
+
+async def fetch_merged_mr_discussions(session, rate_limiter, api_url, project, mr_params):
+    """
+    Lists the merged merge requests of a project and fetches their discussions while the next pages of the
+    list are still being retrieved.
+
+    :param session: The aiohttp session holding the GitLab authentication headers.
+    :param rate_limiter: The RateLimiter shared by all the GitLab requests.
+    :param api_url: The GitLab API base URL (e.g. https://gitlab.com/api/v4).
+    :param project: The GitLab project.
+    :param mr_params: The filters of the merge requests list.
+    :return: The number of merged merge requests, and the (mr_iid, discussions) of the ones having user notes,
+             in listing order.
+    """
+    queue = asyncio.Queue(maxsize=DISCUSSIONS_CONCURRENCY * 2)
+    results = {}
     merged_mr_count = 0
-    reviewed_merged_mr_count = set()
-    conversation_data = []
-    while True:
-        mr_params = {
-            'state': 'merged',
-            'page': page,
-            'per_page': per_page
-        }
-        if args.reviewed_username:
-            mr_params['author_username'] = args.reviewed_username
-
-        merge_requests = project.mergerequests.list(**mr_params)
-        if not merge_requests:
-            break
 
-        for merge_request in merge_requests:
+    async def produce():
+        nonlocal merged_mr_count
+        merge_requests = project.mergerequests.list(iterator=True, **mr_params)
+        # The iterator fetches its pages synchronously, keep it off the event loop
+        while (merge_request := await asyncio.to_thread(next, merge_requests, None)) is not None:
             merged_mr_count += 1
+            if merge_request.user_notes_count:
+                await queue.put((merged_mr_count, merge_request.iid))
+        for _ in range(DISCUSSIONS_CONCURRENCY):
+            await queue.put(None)
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            index, mr_iid = item
+            results[index] = (mr_iid, await fetch_discussions(session, rate_limiter, api_url, project.id, mr_iid))
+
+    await asyncio.gather(produce(), *(consume() for _ in range(DISCUSSIONS_CONCURRENCY)))
+    return merged_mr_count, [results[index] for index in sorted(results)]
 
-            if not merge_request.user_notes_count:
-                continue
 
-            discussions = merge_request.discussions.list(get_all=True)
+async def fetch_gitlab_conversations(args, api_url, private_token, project, mr_params):
+    """
+    Fetches the review conversations of the merged merge requests of a project, and the diffs they refer to.
 
+    :return: The number of merged merge requests, the (mr_iid, conversation) of the review conversations in
+             listing order, and the diffs as returned by prefetch_diffs.
+    """
+    rate_limiter = RateLimiter(GITLAB_REQUESTS_PER_SECOND)
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+    headers = {'PRIVATE-TOKEN': private_token}
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        merged_mr_count, mr_discussions = await fetch_merged_mr_discussions(session, rate_limiter, api_url,
+                                                                            project, mr_params)
+
+        conversations = []
+        for mr_iid, discussions in mr_discussions:
             for discussion in discussions:
                 conversation = filter_and_sort_notes(args.reviewer_username, args.reviewed_username,
-                                                     discussion.attributes['notes'])
+                                                     discussion['notes'])
                 if conversation:
-                    reviewed_merged_mr_count.add(merge_request.iid)
-                    data = collect_conversation_data(conversation)
-                    data[
-                        'conversation_link'] = f"{project_web_url}/-/merge_requests/{merge_request.iid}/{data['conversation_link']}"
-                    data['notes'] = get_notes(conversation)
-                    data['diff_text'] = None
-                    data['discussion_range'] = {'start': {'line': None, 'type': None},
-                                                'end': {'line': None, 'type': None}}
-                    first_note_position = conversation[0].get('position')
-                    if first_note_position:
-                        git_diff = get_git_diff(first_note_position['base_sha'], first_note_position['head_sha'],
-                                                first_note_position['new_path'])
-                        if git_diff:
-                            data['diff_text'] = git_diff
-                        start_line, start_line_type = get_line_and_type_from_position(first_note_position, 'start')
-                        end_line, end_line_type = get_line_and_type_from_position(first_note_position, 'end')
-                        data['discussion_range'] = {'start': {'line': start_line, 'type': start_line_type},
-                                                    'end': {'line': end_line, 'type': end_line_type}}
-                    # start_position = first_note_position['line_range']['start']
-                    # data['reference_code'] = extract_line_from_diff(diff_text, start_position['new_line'], start_position['type'])
-
-                    conversation_data.append(data)
-
-        page += 1
+                    conversations.append((mr_iid, conversation))
+
+        # Many discussions of the same MR point at the same diff, fetch each one only once
+        diff_cache = await prefetch_diffs(session, rate_limiter, api_url, project.id,
+                                          [conversation[0]['position'] for _, conversation in conversations
+                                           if conversation[0].get('position')])
+    return merged_mr_count, conversations, diff_cache
+
+
+def extract_gitlab_conversations(args):
+    personal_access_token = args.gitlab_access_token
+    gl = gitlab.Gitlab(config.GITLAB_URL, private_token=personal_access_token)
+    project = gl.projects.get(config.PROJECT_PATH)
+    project_web_url = project.web_url
+    per_page = 100
+    reviewed_merged_mr_count = set()
+    conversation_data = []
+    mr_params = {
+        'state': 'merged',
+        'per_page': per_page
+    }
+    if args.reviewed_username:
+        mr_params['author_username'] = args.reviewed_username
+
+    merged_mr_count, conversations, diff_cache = asyncio.run(
+        fetch_gitlab_conversations(args, gl.api_url, personal_access_token, project, mr_params))
+
+    for mr_iid, conversation in conversations:
+        reviewed_merged_mr_count.add(mr_iid)
+        data = collect_conversation_data(conversation)
+        data[
+            'conversation_link'] = f"{project_web_url}/-/merge_requests/{mr_iid}/{data['conversation_link']}"
+        data['notes'] = get_notes(conversation)
+        data['diff_text'] = None
+        data['discussion_range'] = {'start': {'line': None, 'type': None},
+                                    'end': {'line': None, 'type': None}}
+        first_note_position = conversation[0].get('position')
+        if first_note_position:
+            git_diff = diff_cache[(first_note_position['base_sha'], first_note_position['head_sha'],
+                                   first_note_position['new_path'])]
+            if git_diff:
+                data['diff_text'] = git_diff
+            start_line, start_line_type = get_line_and_type_from_position(first_note_position, 'start')
+            end_line, end_line_type = get_line_and_type_from_position(first_note_position, 'end')
+            data['discussion_range'] = {'start': {'line': start_line, 'type': start_line_type},
+                                        'end': {'line': end_line, 'type': end_line_type}}
+        # start_position = first_note_position['line_range']['start']
+        # data['reference_code'] = extract_line_from_diff(diff_text, start_position['new_line'], start_position['type'])
+
+        conversation_data.append(data)
+
     print(f'----------------\n\n')
     print(
         f'Total merged merge requests: {merged_mr_count}. Total reviewed merge requests: {len(reviewed_merged_mr_count)}')
@@ -106,16 +276,42 @@ def extract_gitlab_conversations(args):
 
 
 def parse_gitlab_previous_output(file_path):
-    conversation_data = []
-
     with open(file_path, 'r') as file:
-        lines = file.readlines()
+        text = file.read()
+
+    # Conversations are independent of each other, so large outputs are parsed in parallel, by whole conversations
+    chunks = split_previous_output(text, os.cpu_count() or 1) if len(text) >= PARALLEL_PARSE_MIN_SIZE else [text]
+    if len(chunks) == 1:
+        return parse_previous_output_chunk(text)
+    with ProcessPoolExecutor() as executor:
+        return [data for chunk_data in executor.map(parse_previous_output_chunk, chunks) for data in chunk_data]
 
+
+def split_previous_output(text, chunk_count):
+    """
+    Splits a previous output into up to chunk_count chunks of about the same size, each starting with a
+    "Conversation Link:" line (but the first one).
+    """
+    chunk_size = len(text) // chunk_count + 1
+    chunks = []
+    start = 0
+    while True:
+        split = text.find('\nConversation Link:', start + chunk_size)
+        if split == -1:
+            break
+        chunks.append(text[start:split + 1])
+        start = split + 1
+    chunks.append(text[start:])
+    return chunks
+
+
+def parse_previous_output_chunk(text):
+    conversation_data = []
     current_conversation = {}
     reviewers = set()
     first_note_date = None
 
-    for line in lines:
+    for line in io.StringIO(text):
         line = line.strip()
         if line.startswith('Conversation Link:'):
             if current_conversation:
@@ -126,7 +322,7 @@ def parse_gitlab_previous_output(file_path):
             reviewers = set()
             first_note_date = None
             current_conversation['conversation_link'] = line.split(' ')[-1]
-        elif not re.match(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z - ', line):
+        elif not is_note_line(line):
             current_conversation['notes'][-1]['message'] += f'\n{line}'
         elif line:
             timestamp, author_message = line.split(' - ', 1)
@@ -134,8 +330,8 @@ def parse_gitlab_previous_output(file_path):
             reviewers.add(author)
 
             if not first_note_date:
-                first_note_date = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
-                current_conversation['first_note_date'] = first_note_date.strftime('%d-%m-%Y %H:%M:%S.%f')
+                first_note_date = convert_time_format(timestamp)
+                current_conversation['first_note_date'] = first_note_date
 
             current_conversation['notes'].append({'timestamp': timestamp, 'message': author_message})
 
@@ -147,15 +343,28 @@ def parse_gitlab_previous_output(file_path):
     return conversation_data
 
 
+def is_note_line(line):
+    # Cheap structural check first, most lines that fail it are message continuation lines
+    return (len(line) >= 27 and line[4] == '-' and line[10] == 'T' and line[23] == 'Z'
+            and _TS_RE.match(line) is not None)
+
+
 def filter_and_sort_notes(reviewer_username, reviewed_username, notes):
     conversation = []
-    if all(note['author']['username'] == reviewed_username for note in notes):
-        return conversation
+    all_reviewed = True
     for note in notes:
-        if not reviewer_username or note['author']['username'] == reviewer_username:
-            if not note['system']:  # Filter out system notes
-                conversation.append(note)
-    return sorted(conversation, key=itemgetter('created_at'))
+        username = note['author']['username']
+        if username != reviewed_username:
+            all_reviewed = False
+        if note['system']:  # Filter out system notes
+            continue
+        if not reviewer_username or username == reviewer_username:
+            conversation.append(note)
+    # Discussions held only by the reviewed user aren't reviews
+    if all_reviewed:
+        return []
+    conversation.sort(key=itemgetter('created_at'))
+    return conversation
 
 
 def get_notes(conversation):
@@ -171,12 +380,13 @@ def get_notes(conversation):
 
 def collect_conversation_data(conversation):
     first_note_date = convert_time_format(conversation[0]['created_at'])
-    reviewers = {note['author']['username'] for note in conversation}
+    # Ordered dedup, reviewers are listed by their first note
+    reviewers = ', '.join(dict.fromkeys(note['author']['username'] for note in conversation))
     return {
         'conversation_link': f"#note_{conversation[0]['id']}",
         'first_note_date': first_note_date,
         'note_count': len(conversation),
-        'reviewers': ', '.join(reviewers)
+        'reviewers': reviewers
     }
 
 
@@ -190,8 +400,19 @@ def main():
     parser.add_argument('--analyze', default=True)
     parser.add_argument('--result_csv_file', default=f'gpt_analyzed_gitlab_comments_{uuid.uuid4()}.csv')
     parser.add_argument('--raw_json_file', default=f'raw_json_file_gitlab_comments_{uuid.uuid4()}.json')
+    parser.add_argument('--gpt_cache_file', default='gpt_cache.db',
+                        help='File caching the GPT answers across runs, empty to disable')
+    parser.add_argument('--batch_size', type=int, default=5,
+                        help='Number of conversations analyzed by a single GPT request')
+    parser.add_argument('--verbose', action='store_true', help='Log the GPT prompts and answers')
 
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch_size must be at least 1')
+    logging.basicConfig(level=logging.WARNING)
+    # Only this script's own debug output, the openai/httpx loggers would repeat every prompt
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
     # Set default reviewed_username if both arguments are missing
     if not args.reviewed_username and not args.reviewer_username:
@@ -206,7 +427,7 @@ def main():
             save_dict_to_json(conversation_data, args.raw_json_file)
 
     if args.analyze:
-        print_analyze(conversation_data, args.result_csv_file)
+        print_analyze(conversation_data, args.result_csv_file, args.gpt_cache_file, args.batch_size)
 
     else:
         print(f"\n{'MR IID':<75} {'First Note Date':<28} {'Note Count':<3} {'Reviewers'}")
@@ -221,85 +442,249 @@ def get_line_and_type_from_position(first_note_position, direction):
     return side_line, side_line_type
 
 
-def print_analyze(conversation_data, result_csv_file):
+async def analyze_all(conversation_data, cache, on_analyzed, batch_size=1):
+    """
+    Analyze all the conversations concurrently, calling on_analyzed(data, result) for each of them in order as
+    soon as its analysis and the ones before it are done. The result is the exception that failed the analysis,
+    if any.
+
+    Up to batch_size conversations are analyzed by a single GPT request.
+    """
+    sem = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+
+    async def analyze_one(client, prompt):
+        async with sem:
+            return await analyze_review_discussion(client, cache, prompt)
+
+    async def analyze(client, batch):
+        if len(batch) > 1:
+            try:
+                async with sem:
+                    return await analyze_review_discussions(client, cache, batch)
+            except (ValueError, BadRequestError) as e:
+                # Unparsable answer, or a batch still too large for the model
+                logger.warning('Falling back to one request per conversation: %s', e)
+        return await asyncio.gather(*(analyze_one(client, prompt) for prompt in batch), return_exceptions=True)
+
+    prompts = []
     for data in conversation_data:
+        conversation = format_conversation(data['notes'])
+        prompts.append(build_review_prompt(conversation, data['diff_text'], data['discussion_range']))
+
+    # Identical conversations are only sent once, and only the ones missing from the cache are batched
+    unique_prompts = list(dict.fromkeys(prompts))
+    missing_prompts = [prompt for prompt in unique_prompts if get_prompt_cache_key(prompt) not in cache]
+    batches = make_batches(missing_prompts, batch_size)
+    batches += [[prompt] for prompt in unique_prompts if get_prompt_cache_key(prompt) in cache]
+
+    async with AsyncOpenAI(api_key=config.OPENAI_API_KEY) as client:
+        tasks = {}
+        for batch in batches:
+            task = asyncio.ensure_future(analyze(client, batch))
+            for index, prompt in enumerate(batch):
+                tasks[prompt] = (task, index)
+        for data, prompt in zip(conversation_data, prompts):
+            task, index = tasks[prompt]
+            # One failed analysis must not cancel the rest of the batch
+            try:
+                result = (await task)[index]
+            except Exception as e:
+                result = e
+            on_analyzed(data, result)
+
+
+def make_batches(prompts, batch_size):
+    """
+    Groups the prompts in batches of up to batch_size prompts and ANALYZE_BATCH_MAX_CHARS characters, a prompt
+    longer than that goes alone in its batch.
+    """
+    batches = []
+    batch, batch_chars = [], 0
+    for prompt in prompts:
+        if batch and (len(batch) == batch_size or batch_chars + len(prompt) > ANALYZE_BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(prompt)
+        batch_chars += len(prompt)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def print_analyze(conversation_data, result_csv_file, gpt_cache_file=None, batch_size=1):
+    sys.stdout.flush()
+    out = sys.stdout
+    # Block-buffer the report when it isn't shown on a terminal
+    if not sys.stdout.isatty():
         try:
-            conversation = '\n'.join(f"{n['reviewer']}: {n['body']}" for n in data['notes'])
-            data['analyze'] = analyze_review_discussion(conversation, data['diff_text'], data['discussion_range'])
-        except Exception as e:
-            print(f'print_analyze error: "{e}"')
-    print(f"\n{'MR IID':<75} {'First Note Date':<28} {'Note Count':<3} {'Analyze':<40} {'Reviewers'}")
+            out = open(sys.stdout.fileno(), 'w', buffering=STDOUT_BUFFER_SIZE, encoding=sys.stdout.encoding,
+                       closefd=False)
+        except (AttributeError, io.UnsupportedOperation):
+            # Not backed by a file descriptor (e.g. redirected to a StringIO)
+            pass
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(contextlib.redirect_stdout(out))
+        cache = stack.enter_context(shelve.open(gpt_cache_file) if gpt_cache_file else contextlib.nullcontext({}))
+        writer = None
+        if result_csv_file:
+            file = stack.enter_context(open(result_csv_file, mode='w', newline='', encoding='utf-8',
+                                            buffering=WRITE_BUFFER_SIZE))
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDNAMES, extrasaction='ignore')
+            writer.writeheader()
+
+        out.write(f"\n{'MR IID':<75} {'First Note Date':<28} {'Note Count':<3} {'Analyze':<40} {'Reviewers'}\n")
+
+        def on_analyzed(data, result):
+            if isinstance(result, Exception):
+                out.write(f'print_analyze error: "{result}"\n')
+            else:
+                data['analyze'] = result
+            out.write(f"{data['conversation_link']:<75} {data['first_note_date']:<25} {data['note_count']:<3} "
+                      f"{data.get('analyze', ''):<40} {data['reviewers']}\n")
+            if writer:
+                writer.writerow(get_csv_row(data))
+
+        asyncio.run(analyze_all(conversation_data, cache, on_analyzed, batch_size))
+    out.flush()
+
+
+def get_csv_row(data):
+    return {
+        'MR IID': data['conversation_link'],
+        'First Note Date': data['first_note_date'],
+        'Note Count': data['note_count'],
+        'Analyze': data.get('analyze'),
+        'Reviewers': data['reviewers']
+    }
 
-    for data in conversation_data:
-        print(
-            f"{data['conversation_link']:<75} {data['first_note_date']:<25} {data['note_count']:<3} {data['analyze']:<40} {data['reviewers']}")
-    if result_csv_file:
-        print_to_csv(conversation_data, result_csv_file)
+
+async def stream_completion(client, **kwargs):
+    """
+    Request a chat completion as a stream and assemble its content as the tokens arrive.
+    """
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    parts = []
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+    finally:
+        await stream.response.aclose()
+    return ''.join(parts)
 
 
-def print_to_csv(conversation_data, csv_file):
-    with open(csv_file, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
+def format_conversation(notes):
+    parts = []
+    parts_append = parts.append
+    for note in notes:
+        parts_append(note['reviewer'])
+        parts_append(': ')
+        parts_append(note['body'])
+        parts_append('\n')
+    # No trailing newline after the last note
+    return ''.join(parts[:-1])
 
-        # Writing the header
-        writer.writerow(['MR IID', 'First Note Date', 'Note Count', 'Analyze', 'Reviewers'])
 
-        # Writing data rows
-        for data in conversation_data:
-            writer.writerow([
-                data['conversation_link'],
-                data['first_note_date'],
-                data['note_count'],
-                data['analyze'],
-                data['reviewers']
-            ])
+def build_review_prompt(conversation, diff_text, discussion_range):
+    s_range = discussion_range['start']
+    e_range = discussion_range['end']
+    s_line, s_type = s_range['line'], s_range['type']
+    e_line, e_type = e_range['line'], e_range['type']
+    return _REVIEW_PROMPT.format(conversation=conversation, s_line=s_line, s_type=s_type, e_line=e_line,
+                                 e_type=e_type, diff_text=diff_text)
+    # return (f"I need you to analyze a code review discussion. "
+    #         f"Get me the insight from this discussion. It can be 10-15 words in instruction format (\"if/when ... do ....\")."
+    #         f"The Conversation: \n\"\n{conversation}\n\".\n"
+    #         f"The discussion is references to the code change introduce by the following diff - "
+    #         f"The discussion refers to the code change introduced by the following diff - "
+    #         f"the exact change is ranged between lines {s_range['line']} ({s_range['type']}) "
+    #         f"and {e_range['line']} ({e_range['type']}):\n```\n{diff_text}\n```\n")
 
 
-def analyze_review_discussion(conversation, diff_text, discussion_range):
+def get_prompt_cache_key(prompt):
+    return hashlib.sha256(f'{GPT_MODEL}\n{prompt}'.encode()).hexdigest()
+
+
+async def analyze_review_discussion(client, cache, prompt):
     """
     Send a request to the GPT API to analyze a review discussion.
 
+    :param client: The AsyncOpenAI client shared by the concurrent requests.
+    :param cache: Mapping of the previous answers, keyed by get_prompt_cache_key.
+    :param prompt: The prompt built by build_review_prompt.
     :return: The response from the GPT API.
     """
     # Endpoint for the GPT API
     endpoint = "https://api.openai.com/v1/engines/gpt-4/completions"
 
-    # Prepare the prompt
-    s_range = discussion_range['start']
-    e_range = discussion_range['end']
-    s_line, s_type = s_range['line'], s_range['type']
-    e_line, e_type = e_range['line'], e_range['type']
-    prompt = (f"Get me the insight from this code review discussion. up to 7 words:"
-              f"\n\"\n{conversation}\n\".\n"
-              f"The discussion refers to the code change introduced by the following diff - "
-              f"the exact change is ranged between lines {s_line} ({s_type}) and {e_line} ({e_type}):"
-              f"\n```\n{diff_text}\n```\n")
-    # prompt = (f"I need you to analyze a code review discussion. "
-    #           f"Get me the insight from this discussion. It can be 10-15 words in instruction format (\"if/when ... do ....\")."
-    #           f"The Conversation: \n\"\n{conversation}\n\".\n"
-    #           f"The discussion is references to the code change introduce by the following diff - "
-    #           f"The discussion refers to the code change introduced by the following diff - "
-    #           f"the exact change is ranged between lines {s_range['line']} ({s_range['type']}) "
-    #           f"and {e_range['line']} ({e_range['type']}):\n```\n{diff_text}\n```\n")
-    print(f'{prompt=}')
+    logger.debug('prompt=%r', prompt)
+    key = get_prompt_cache_key(prompt)
+    if key in cache:
+        answer = cache[key]['answer']
+        logger.debug('answer=%r (cached)', answer)
+        return answer
 
-    messages = [{"role": "user", "content": prompt}]
+    answer = await request_completion(client, prompt, max_tokens=105, timeout=ANALYZE_TIMEOUT)
+    logger.debug('answer=%r', answer)
+    cache[key] = {'prompt': prompt, 'answer': answer, 'model': GPT_MODEL}
+    return answer
+    # return completion.choices[0].message.content
 
-    # completion = openai.chat.completions.create(model="gpt-3.5-turbo", max_tokens=105, temperature=0.7, messages=messages)
 
-    client = OpenAI(api_key=config.OPENAI_API_KEY)
+async def analyze_review_discussions(client, cache, prompts):
+    """
+    Send a single request to the GPT API to analyze several review discussions.
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-    def completion_with_backoff(**kwargs):
-        return client.chat.completions.create(**kwargs)
+    :param client: The AsyncOpenAI client shared by the concurrent requests.
+    :param cache: Mapping of the previous answers, keyed by get_prompt_cache_key.
+    :param prompts: The prompts built by build_review_prompt.
+    :return: The responses, in the order of the prompts.
+    :raises ValueError: If the response doesn't hold exactly one answer per prompt.
+    """
+    batch_prompt = _BATCH_PROMPT.format(count=len(prompts)) + ''.join(
+        _BATCH_PROMPT_ITEM.format(index=index, prompt=prompt) for index, prompt in enumerate(prompts))
+    logger.debug('prompt=%r', batch_prompt)
+    answer = await request_completion(client, batch_prompt, max_tokens=105 * len(prompts),
+                                      timeout=ANALYZE_TIMEOUT * len(prompts))
+    logger.debug('answer=%r', answer)
+    answers = parse_batch_answer(answer, len(prompts))
+    # Stored per conversation, so that later runs hit the cache whatever the batches are
+    for prompt, answer in zip(prompts, answers):
+        cache[get_prompt_cache_key(prompt)] = {'prompt': prompt, 'answer': answer, 'model': GPT_MODEL}
+    return answers
+
+
+def parse_batch_answer(answer, count):
+    text = answer.strip()
+    # The JSON may come wrapped in a markdown code block
+    if text.startswith('```'):
+        text = text.strip('`').removeprefix('json')
+    try:
+        insights = orjson.loads(text)['insights']
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Unexpected batch answer: {answer!r}') from e
+    if not isinstance(insights, list) or len(insights) != count or not all(isinstance(i, str) for i in insights):
+        raise ValueError(f'Expected {count} insights in batch answer: {answer!r}')
+    return insights
 
-    response = completion_with_backoff(model="gpt-4", max_tokens=105, temperature=0.7, messages=messages)
-    answer = response.choices[0].message.content
-    print(f'{answer=}')
+
+async def request_completion(client, prompt, max_tokens, timeout):
+    messages = [{"role": "user", "content": prompt}]
+
+    # completion = openai.chat.completions.create(model="gpt-3.5-turbo", max_tokens=105, temperature=0.7, messages=messages)
+
+    # A bad request (e.g. over the context length) fails the same way every time, don't retry it
+    async for attempt in AsyncRetrying(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6),
+                                       retry=retry_if_not_exception_type(BadRequestError), reraise=True):
+        with attempt:
+            # A stalled stream is cancelled and retried
+            answer = await asyncio.wait_for(
+                stream_completion(client, model=GPT_MODEL, max_tokens=max_tokens, temperature=0.7, messages=messages),
+                timeout=timeout)
     return answer
-    # return completion.choices[0].message.content
 
 
+@functools.lru_cache(maxsize=4096)
 def get_git_diff(base_sha, head_sha, path):
     """
     Executes a git diff command and returns the diff output.
@@ -312,17 +697,7 @@ def get_git_diff(base_sha, head_sha, path):
     command = ["git", "diff", "--color=never", f"{base_sha}..{head_sha}", "--", path]
     try:
         result = subprocess.run(command, capture_output=True, text=True, check=True)
-        diff_lines = result.stdout.splitlines()
-
-        # Skip meta-information lines at the beginning of the diff output
-        start_line = 0
-        for line in diff_lines:
-            if line.startswith("@@"):
-                break
-            start_line += 1
-
-        # Return the diff output from the first @@ line
-        return '\n'.join(diff_lines[start_line:])
+        return strip_diff_header(result.stdout.splitlines())
     except subprocess.CalledProcessError as e:
         print(f"Error occurred: {e}")
         print(f"Standard Output: {e.stdout}")
@@ -330,6 +705,132 @@ def get_git_diff(base_sha, head_sha, path):
         return None
 
 
+def get_git_diffs(base_sha, head_sha, paths):
+    """
+    Executes a single git diff command for several paths and splits its output per file.
+
+    :param base_sha: The base SHA for the diff.
+    :param head_sha: The head SHA for the diff.
+    :param paths: The paths of the files to diff.
+    :return: A dict mapping each changed path to its diff, or None if git failed.
+    """
+    command = ["git", "diff", "--color=never", f"{base_sha}..{head_sha}", "--", *paths]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        error_output = e.stderr.strip().splitlines()
+        print(f"Error occurred: {e} {error_output[0] if error_output else ''}")
+        return None
+
+    diffs = {}
+    file_lines = []
+    for line in result.stdout.splitlines() + ['diff --git']:
+        if line.startswith('diff --git') and file_lines:
+            path = get_diff_file_path(file_lines)
+            if path:
+                diffs[path] = strip_diff_header(file_lines)
+            file_lines = []
+        file_lines.append(line)
+    return diffs
+
+
+async def prefetch_diffs(session, rate_limiter, api_url, project_id, positions):
+    """
+    Fetches the diffs of the given note positions, comparing each (base_sha, head_sha) pair once.
+
+    The diffs come from the GitLab compare API; files GitLab doesn't return a diff for (e.g. too large or
+    collapsed) are diffed with git in the local repository instead.
+
+    :param session: The aiohttp session holding the GitLab authentication headers.
+    :param rate_limiter: The RateLimiter shared by all the GitLab requests.
+    :param api_url: The GitLab API base URL (e.g. https://gitlab.com/api/v4).
+    :param project_id: The id of the GitLab project the positions belong to.
+    :param positions: The GitLab note positions.
+    :return: A dict mapping (base_sha, head_sha, new_path) to the diff output.
+    """
+    paths_by_shas = defaultdict(set)
+    for position in positions:
+        paths_by_shas[(position['base_sha'], position['head_sha'])].add(position['new_path'])
+
+    sem = asyncio.Semaphore(DISCUSSIONS_CONCURRENCY)
+
+    async def compare(base_sha, head_sha):
+        async with sem:
+            return await fetch_compare_diffs(session, rate_limiter, api_url, project_id, base_sha, head_sha)
+
+    all_diffs = await asyncio.gather(*(compare(base_sha, head_sha) for base_sha, head_sha in paths_by_shas))
+
+    diff_cache = {}
+    for ((base_sha, head_sha), paths), diffs in zip(paths_by_shas.items(), all_diffs):
+        missing_paths = sorted(path for path in paths if path not in diffs)
+        git_diffs = get_git_diffs(base_sha, head_sha, missing_paths) if missing_paths else {}
+        for path in paths:
+            if path in diffs:
+                diff_text = diffs[path]
+            elif git_diffs is None:
+                # git itself failed (e.g. no local clone), diffing path by path would fail the same way
+                diff_text = None
+            elif path in git_diffs:
+                diff_text = git_diffs[path]
+            else:
+                # Fall back to a single-path diff for anything the batched output couldn't be matched to
+                diff_text = get_git_diff(base_sha, head_sha, path)
+            diff_cache[(base_sha, head_sha, path)] = diff_text
+    return diff_cache
+
+
+async def fetch_compare_diffs(session, rate_limiter, api_url, project_id, base_sha, head_sha):
+    """
+    Compares two commits through the GitLab API.
+
+    :param session: The aiohttp session holding the GitLab authentication headers.
+    :param rate_limiter: The RateLimiter shared by all the GitLab requests.
+    :param api_url: The GitLab API base URL (e.g. https://gitlab.com/api/v4).
+    :param project_id: The id of the GitLab project holding the commits.
+    :param base_sha: The base SHA for the diff.
+    :param head_sha: The head SHA for the diff.
+    :return: A dict mapping each changed path to its diff, or an empty dict if the comparison failed.
+    """
+    url = f"{api_url}/projects/{project_id}/repository/compare"
+    params = {'from': base_sha, 'to': head_sha, 'straight': 'true'}
+    try:
+        compare, _ = await get_gitlab_json(session, rate_limiter, url, params)
+    except aiohttp.ClientError as e:
+        print(f"Error occurred comparing {base_sha}..{head_sha}: {e}")
+        return {}
+    return {diff['new_path']: strip_diff_header(diff['diff'].splitlines())
+            for diff in compare['diffs'] if diff['diff']}
+
+
+def get_diff_file_path(file_lines):
+    """
+    Returns the path of the file described by the header of a single-file diff, or None if unknown.
+    """
+    old_path = None
+    for line in file_lines:
+        if line.startswith('@@'):
+            break
+        if line.startswith('--- a/'):
+            old_path = line[len('--- a/'):]
+        elif line.startswith('+++ b/'):
+            return line[len('+++ b/'):]
+        elif line == '+++ /dev/null':
+            return old_path
+    return None
+
+
+def strip_diff_header(diff_lines):
+    # Skip meta-information lines at the beginning of the diff output
+    start_line = 0
+    for line in diff_lines:
+        if line.startswith("@@"):
+            break
+        start_line += 1
+
+    # Return the diff output from the first @@ line
+    return '\n'.join(diff_lines[start_line:])
+
+
 def extract_line_from_diff(diff_text, line_number, line_type='new'):
     """
     Extracts a specific line from a git diff.
@@ -343,32 +844,30 @@ def extract_line_from_diff(diff_text, line_number, line_type='new'):
     current_line_number_old, current_line_number_new = None, None
 
     for line in lines:
-        if line.startswith('@@'):
+        c = line[:1]
+        hunk_header = _HUNK_RE.match(line) if c == '@' else None
+        if hunk_header:
             # Example format: @@ -12965,7 +12965,8 @@
-            parts = line.split(' ')
-            old_line_info, new_line_info = parts[1], parts[2]
-            current_line_number_old = int(old_line_info.split(',')[0][1:])
-            current_line_number_new = int(new_line_info.split(',')[0][1:])
-        else:
-            if line_type == 'new':
-                if line.startswith('+'):
-                    current_line_number_new += 1
-                elif not line.startswith('-'):
-                    current_line_number_new += 1
-                    current_line_number_old += 1
-
-                if current_line_number_new == line_number:
-                    return line[1:].strip()  # Strip the '+' and any leading/trailing whitespace
-
-            elif line_type == 'old':
-                if line.startswith('-'):
-                    current_line_number_old += 1
-                elif not line.startswith('+'):
-                    current_line_number_old += 1
-                    current_line_number_new += 1
-
-                if current_line_number_old == line_number:
-                    return line[1:].strip()  # Strip the '-' and any leading/trailing whitespace
+            current_line_number_old, current_line_number_new = int(hunk_header[1]), int(hunk_header[2])
+        elif line_type == 'new':
+            if c == '+':
+                current_line_number_new += 1
+            elif c != '-':
+                current_line_number_new += 1
+                current_line_number_old += 1
+
+            if current_line_number_new == line_number:
+                return line[1:].strip()  # Strip the '+' and any leading/trailing whitespace
+
+        elif line_type == 'old':
+            if c == '-':
+                current_line_number_old += 1
+            elif c != '+':
+                current_line_number_old += 1
+                current_line_number_new += 1
+
+            if current_line_number_old == line_number:
+                return line[1:].strip()  # Strip the '-' and any leading/trailing whitespace
 
     return None
 